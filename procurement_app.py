@@ -1,16 +1,21 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta, date 
-import os 
+import os
+import io
 import json
 import gspread
 import logging
 import time
+import threading
+import queue
 import base64
 import extra_streamlit_components
 # GCS 相關導入
 import extra_streamlit_components as stx
-from google.cloud import storage 
+from google.cloud import storage
+from google.cloud.exceptions import NotFound
 from google.oauth2 import service_account
 
 # ******************************
@@ -92,6 +97,21 @@ CUSTOM_CSS = """
 
 STATUS_OPTIONS = ["詢價中", "已報價", "待採購", "已採購", "運送中", "已到貨", "已驗收", "取消"]
 
+# data_editor 的欄位設定不會變，模組層建一次即可，
+# 免得每個 rerun 對每張表重建十個 column_config 物件再序列化
+EDITOR_COLUMN_CONFIG = {
+    "選取": st.column_config.CheckboxColumn(width="tiny"),
+    "單價": st.column_config.NumberColumn(format="$%d"),
+    "總價": st.column_config.NumberColumn(format="$%d", disabled=True),
+    "預計交貨日": st.column_config.DateColumn(format="YYYY-MM-DD", step=1),
+    "狀態": st.column_config.SelectboxColumn(options=STATUS_OPTIONS),
+    "最後修改時間": st.column_config.TextColumn(disabled=True),
+    "附件名稱": st.column_config.TextColumn(disabled=True, width="medium"),
+    "預覽": st.column_config.CheckboxColumn(width="small", label="預覽(單選)"),
+    "標記刪除": st.column_config.CheckboxColumn(width="tiny")
+}
+EDITOR_COLUMN_ORDER = ['選取', '供應商', '單價', '數量', '總價', '預計交貨日', '交期判定', '狀態', '最後修改時間', '附件名稱', '預覽', '標記刪除']
+
 
 # ******************************
 # *--- 2. 認證與安全 (Cookie 整合) ---*
@@ -170,6 +190,10 @@ def login_form():
     st.stop()
 
 
+# DataFrame 引數用輕量 hash (shape + 列雜湊總和)，不走 Streamlit 預設的深度雜湊
+_DF_HASH_FUNCS = {pd.DataFrame: lambda d: (d.shape, int(pd.util.hash_pandas_object(d, index=True).sum()))}
+
+
 # ******************************
 # *--- 3. 外部服務 (GCS & Utils) ---*
 # ******************************
@@ -188,19 +212,30 @@ def get_gcs_signing_client():
         st.error(f"GCS Client 載入失敗：{e}")
         raise
 
-def get_gcs_client_standard():
-    """獲取標準 GCS Client (用於一般上傳/刪除)。"""
-    return storage.Client()
+@st.cache_data(ttl=3500, show_spinner=False)
+def generate_signed_url_cached(gcs_uri):
+    """產生 Signed URL 並快取，避免每次 rerun 重新簽名 (TTL 略短於 URL 有效期)。"""
+    client = get_gcs_signing_client()
+    bucket = client.bucket(GCS_BUCKET_NAME)
+    blob = bucket.blob(gcs_uri)
+    return blob.generate_signed_url(version="v4", expiration=timedelta(hours=1), method="GET")
+
+@st.cache_resource
+def get_gcs_bucket():
+    """共用的標準 GCS bucket handle (用於一般上傳/刪除)。
+    快取起來才不會每個檔案操作都重跑憑證探索與連線池建立。"""
+    return storage.Client().bucket(GCS_BUCKET_NAME)
 
 def save_uploaded_file(uploaded_file, quote_id):
     """上傳檔案至 GCS。"""
     if uploaded_file is None: return None
     try:
-        client = get_gcs_client_standard()
-        bucket = client.bucket(GCS_BUCKET_NAME)
+        bucket = get_gcs_bucket()
         destination_blob_name = f"{GCS_FOLDER_PATH}/{quote_id}_{uploaded_file.name}"
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_string(uploaded_file.getvalue(), content_type=uploaded_file.type)
+        # 直接從上傳緩衝串流，不先 getvalue() 在記憶體多複製一份
+        uploaded_file.seek(0)
+        blob.upload_from_file(uploaded_file, content_type=uploaded_file.type, size=uploaded_file.size)
         return destination_blob_name
     except Exception as e:
         logging.error(f"GCS 上傳失敗: {e}")
@@ -211,225 +246,421 @@ def delete_file_from_gcs(gcs_object_name):
     """刪除 GCS 檔案。"""
     if not gcs_object_name: return True
     try:
-        client = get_gcs_client_standard()
-        bucket = client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(gcs_object_name)
-        if blob.exists(): blob.delete()
+        bucket = get_gcs_bucket()
+        # 直接 delete，檔案不存在視同已刪；省掉 exists() 多打一次 HEAD
+        try: bucket.blob(gcs_object_name).delete()
+        except NotFound: pass
         return True
     except Exception as e:
         logging.error(f"GCS 刪除失敗: {e}")
         return False
 
+def delete_files_from_gcs(gcs_object_names):
+    """用單一 batch 請求刪除多個 GCS 檔案，取代逐檔來回。"""
+    names = [str(n).strip() for n in gcs_object_names if str(n).strip()]
+    if not names: return True
+    try:
+        bucket = get_gcs_bucket()
+        with bucket.client.batch(raise_exception=False):
+            for name in names:
+                bucket.blob(name).delete()
+        return True
+    except Exception as e:
+        logging.error(f"GCS 批次刪除失敗: {e}")
+        return False
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs=_DF_HASH_FUNCS)
+def convert_df_to_excel(df):
+    """匯出採購總表為 Excel bytes。xlsxwriter 不像 openpyxl
+    先在記憶體建整棵 workbook XML 樹。
+    注意不能開 constant_memory：to_excel 逐欄寫儲存格，
+    constant_memory 會把已 flush 的列丟掉，匯出檔只剩第一欄。"""
+    df_export = df.drop(columns=['交期判定', '預覽', '附件名稱'], errors='ignore')
+    # 逐欄先定型 (日期→字串、金額→float)，寫入迴圈不必每格做型別分派
+    for col in ('預計交貨日', '採購最慢到貨日'):
+        if col in df_export.columns:
+            df_export[col] = pd.to_datetime(df_export[col], errors='coerce').dt.strftime(DATE_FORMAT).fillna('')
+    for col in ('單價', '總價'):
+        if col in df_export.columns:
+            df_export[col] = pd.to_numeric(df_export[col], errors='coerce').round(2)
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter',
+                        engine_kwargs={'options': {'strings_to_numbers': False}}) as writer:
+        df_export.to_excel(writer, index=False, sheet_name=DATA_SHEET_NAME)
+        # 金額欄位用整欄格式，不逐格套樣式
+        money_fmt = writer.book.add_format({'num_format': '$#,##0'})
+        worksheet = writer.sheets[DATA_SHEET_NAME]
+        for col in ('單價', '總價'):
+            if col in df_export.columns:
+                idx = df_export.columns.get_loc(col)
+                worksheet.set_column(idx, idx, None, money_fmt)
+    return output.getvalue()
+
 def add_business_days(start_date, num_days):
-    """計算工作日。"""
-    current_date = start_date
-    days_added = 0
-    while days_added < num_days:
-        current_date += timedelta(days=1)
-        if current_date.weekday() < 5: days_added += 1
-    return current_date
+    """計算工作日。roll='backward' 讓週末起算時與逐日累加的結果一致。"""
+    return np.busday_offset(np.datetime64(start_date), num_days, roll='backward').item()
+
+def now_str():
+    """事件發生當下的時間戳字串；每個 handler 事件只取一次。"""
+    return time.strftime(DATETIME_FORMAT)
 
 
 # ******************************
 # *--- 4. 數據處理 (Google Sheets) ---*
 # ******************************
 
-def load_data_from_sheets():
-    expected_cols = ['ID', '選取', '專案名稱', '專案項目', '供應商', '單價', '數量', '總價', '預計交貨日', '狀態', '採購最慢到貨日', '最後修改時間', '附件', '標記刪除']
-    
+@st.cache_resource
+def get_gspread_client():
+    """共用的 gspread client (底層 requests.Session 連線池)，避免每次讀寫重做 OAuth/TLS 交握。"""
+    return gspread.service_account(filename=GSHEETS_CREDENTIALS)
+
+@st.cache_resource
+def get_spreadsheet():
+    """共用的 Spreadsheet handle：open_by_url 是一次 Drive API 往返，每個 process 做一次就好。"""
+    return get_gspread_client().open_by_url(SHEET_URL)
+
+def _frame_from_values(values):
+    """把 values.batchGet 回傳的二維陣列轉成 DataFrame
+    (首列為欄名，短列補空字串、表格右側多出的雜散儲存格截掉)。"""
+    if not values or len(values) < 2:
+        return pd.DataFrame(columns=values[0] if values else [])
+    header = values[0]
+    rows = [r[:len(header)] + [''] * (len(header) - len(r)) for r in values[1:]]
+    return pd.DataFrame(rows, columns=header)
+
+EXPECTED_DATA_COLS = ['ID', '選取', '專案名稱', '專案項目', '供應商', '單價', '數量', '總價', '預計交貨日', '狀態', '採購最慢到貨日', '最後修改時間', '附件', '標記刪除']
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_data_from_sheets_cached(version):
+    """快取的 Sheets 讀取，回傳 (data_df, project_metadata)。
+    version 由寫入路徑遞增，寫入後的讀取必定重抓；失敗直接 raise —
+    st.cache_data 不快取例外，暫時性 5xx 才不會以失敗結果卡滿整段 TTL。
+    UI 訊息由外層包裝函式處理。"""
+    expected_cols = EXPECTED_DATA_COLS
+
     if not SHEET_URL: return pd.DataFrame(columns=expected_cols), {}
 
+    if not GSHEETS_CREDENTIALS or not os.path.exists(GSHEETS_CREDENTIALS):
+        raise FileNotFoundError("憑證檔案不存在")
+
+    sh = get_spreadsheet()
+
+    # 兩張工作表用一次 batchGet 讀完：單一 HTTP 往返，
+    # 也省掉 get_all_records 逐格 numericise 的額外成本
+    resp = sh.values_batch_get(ranges=[f"'{DATA_SHEET_NAME}'", f"'{METADATA_SHEET_NAME}'"])
+    value_ranges = resp.get('valueRanges', [])
+    data_values = value_ranges[0].get('values', []) if len(value_ranges) > 0 else []
+    metadata_values = value_ranges[1].get('values', []) if len(value_ranges) > 1 else []
+
+    data_df = _frame_from_values(data_values)
+
+    if data_df.empty: data_df = pd.DataFrame(columns=expected_cols)
+    else:
+        for col in expected_cols:
+            if col not in data_df.columns:
+                if col in ['ID', '數量']: data_df[col] = 0
+                elif col in ['單價', '總價']: data_df[col] = 0.0
+                elif col in ['選取', '標記刪除']: data_df[col] = False
+                else: data_df[col] = ''
+
+    # batchGet 回傳的布林欄一律是 'TRUE'/'FALSE' 字串，整欄向量化比對即可
+    for col in ['選取', '標記刪除']:
+        if col in data_df.columns:
+            data_df[col] = data_df[col].astype(str).str.strip().str.upper().eq('TRUE')
+
+    # batchGet 回傳的都是字串，數值欄位明確轉型
+    for col in ['單價', '總價']:
+        if col in data_df.columns:
+            data_df[col] = pd.to_numeric(data_df[col], errors='coerce').fillna(0.0)
+    for col in ['ID', '數量']:
+        if col in data_df.columns:
+            data_df[col] = pd.to_numeric(data_df[col], errors='coerce').astype('Int64')
+
+    if '附件' in data_df.columns: data_df['附件'] = data_df['附件'].astype(str)
+
+    # 字串欄位改用 pyarrow backend：記憶體較省、groupby 走 C 層雜湊。
+    # 環境沒有 pyarrow 就維持 object dtype，行為不變。
     try:
-        if not GSHEETS_CREDENTIALS or not os.path.exists(GSHEETS_CREDENTIALS):
-             raise FileNotFoundError("憑證檔案不存在")
-             
-        gc = gspread.service_account(filename=GSHEETS_CREDENTIALS)
-        sh = gc.open_by_url(SHEET_URL)
-        
-        # 讀取 Data
-        try:
-            data_ws = sh.worksheet(DATA_SHEET_NAME)
-            data_df = pd.DataFrame(data_ws.get_all_records())
-        except:
-            st.error(f"找不到工作表：{DATA_SHEET_NAME}")
-            data_df = pd.DataFrame(columns=expected_cols)
-
-        if data_df.empty: data_df = pd.DataFrame(columns=expected_cols)
-        else:
-            for col in expected_cols:
-                if col not in data_df.columns:
-                    if col in ['ID', '數量']: data_df[col] = 0
-                    elif col in ['單價', '總價']: data_df[col] = 0.0
-                    elif col in ['選取', '標記刪除']: data_df[col] = False
-                    else: data_df[col] = ''
-
-        def clean_bool(x):
-            if isinstance(x, bool): return x
-            return str(x).strip().upper() == 'TRUE'
-
-        for col in ['選取', '標記刪除']:
-            if col in data_df.columns: data_df[col] = data_df[col].apply(clean_bool)
-
-        dtype_map = {'ID': 'Int64', '單價': 'float', '數量': 'Int64', '總價': 'float'}
-        data_df = data_df.astype({k: v for k, v in dtype_map.items() if k in data_df.columns}, errors='ignore')
-        
-        if '附件' in data_df.columns: data_df['附件'] = data_df['附件'].astype(str)
-        for col in ['預計交貨日', '採購最慢到貨日']:
-            if col in data_df.columns: data_df[col] = pd.to_datetime(data_df[col], errors='coerce', format=DATE_FORMAT)
-
-        # 讀取 Metadata
-        try:
-            metadata_ws = sh.worksheet(METADATA_SHEET_NAME)
-            metadata_records = metadata_ws.get_all_records()
-        except:
-            st.error(f"找不到工作表：{METADATA_SHEET_NAME}")
-            metadata_records = []
-            
-        project_metadata = {}
-        for row in metadata_records:
-            try: due_date = pd.to_datetime(str(row['專案交貨日'])).date()
-            except: due_date = datetime.now().date()
-            project_metadata[row['專案名稱']] = {
-                'due_date': due_date,
-                'buffer_days': int(row.get('緩衝天數', 7)),
-                'last_modified': str(row.get('最後修改', ''))
-            }
-
-        st.success(f"✅ 數據同步完成 (來源: {DATA_SHEET_NAME})") 
-        return data_df, project_metadata
+        for col in ['專案名稱', '專案項目', '供應商', '狀態', '附件', '最後修改時間']:
+            if col in data_df.columns:
+                data_df[col] = data_df[col].astype(str).astype('string[pyarrow]')
+    except (ImportError, TypeError):
+        pass
+    for col in ['預計交貨日', '採購最慢到貨日']:
+        if col in data_df.columns: data_df[col] = pd.to_datetime(data_df[col], errors='coerce', format=DATE_FORMAT)
+
+    # Metadata：整批向量化解析，不逐列 strptime
+    project_metadata = {}
+    meta_df = _frame_from_values(metadata_values)
+    if not meta_df.empty:
+        if '專案名稱' in meta_df.columns:
+            if '專案交貨日' in meta_df.columns:
+                due = pd.to_datetime(meta_df['專案交貨日'].astype(str), errors='coerce')
+            else:
+                due = pd.Series(pd.NaT, index=meta_df.index)
+            meta_df['due_date'] = due.dt.date.where(due.notna(), datetime.now().date())
+            if '緩衝天數' in meta_df.columns:
+                meta_df['buffer_days'] = pd.to_numeric(meta_df['緩衝天數'], errors='coerce').fillna(7).astype(int)
+            else:
+                meta_df['buffer_days'] = 7
+            meta_df['last_modified'] = meta_df['最後修改'].astype(str) if '最後修改' in meta_df.columns else ''
+            project_metadata = meta_df.set_index('專案名稱')[['due_date', 'buffer_days', 'last_modified']].to_dict('index')
+
+    # 以載入的內容播種寫入快照：本 process 第一次儲存就能走差異寫入，
+    # 不必整表 clear+重寫一次才建立比對基準
+    state = get_sheet_write_state()
+    if state['snapshots'] is None:
+        seed_data, seed_meta = _prepare_sheet_values(data_df, project_metadata)
+        state['snapshots'] = {'data': seed_data, 'metadata': seed_meta}
 
+    return data_df, project_metadata
+
+def load_data_from_sheets():
+    try:
+        data_df, project_metadata = _load_data_from_sheets_cached(st.session_state.get('data_version', 0))
     except Exception as e:
         st.error(f"❌ 數據載入失敗: {e}")
         st.session_state.data_load_failed = True
-        return pd.DataFrame(columns=expected_cols), {}
+        return pd.DataFrame(columns=EXPECTED_DATA_COLS), {}
+
+    # 成功載入就解除寫入封鎖，重新整理後的 session 才能繼續儲存
+    st.session_state.data_load_failed = False
+    st.success(f"✅ 數據同步完成 (來源: {DATA_SHEET_NAME})")
+    return data_df, project_metadata
+
+def _pad_rows(values, width):
+    return [list(r) + [''] * (width - len(r)) for r in values]
+
+def _diff_value_ranges(sheet_name, old_values, new_values):
+    """逐列比對上次寫入的快照，只回傳有變動的列 (被刪除的尾端列以空白覆蓋)。"""
+    width = max([len(r) for r in old_values + new_values] or [0])
+    old_padded = _pad_rows(old_values, width)
+    new_padded = _pad_rows(new_values, width)
+    while len(new_padded) < len(old_padded):
+        new_padded.append([''] * width)
+
+    changed = []
+    for i, row in enumerate(new_padded):
+        if i >= len(old_padded) or old_padded[i] != row:
+            changed.append({'range': f"'{sheet_name}'!A{i + 1}", 'values': [row]})
+    return changed
+
+def _prepare_sheet_values(df_to_write, metadata_to_write):
+    """把 DataFrame / metadata 轉成要上傳的儲存格值 (在 script 執行緒先做完快照)。"""
+    df_export = df_to_write.drop(columns=['交期判定', '交期顯示', '預覽', '附件名稱'], errors='ignore')
+    for col in ['預計交貨日', '採購最慢到貨日']:
+        if col in df_export.columns:
+            df_export[col] = pd.to_datetime(df_export[col], errors='coerce').dt.strftime(DATE_FORMAT).fillna("")
+
+    # Int64 等 masked dtype 不接受 fillna("")，先轉 object 再以空字串補 NA；
+    # Sheet 上手改壞的 ID/數量儲存格 (coerce 成 NA) 才不會讓整次寫入炸掉
+    df_export = df_export.astype(object).where(df_export.notna(), "")
+    for col in ['選取', '標記刪除']:
+        if col in df_export.columns: df_export[col] = df_export[col].astype(bool)
+    if '附件' in df_export.columns: df_export['附件'] = df_export['附件'].astype(str)
+
+    data_values = [df_export.columns.values.tolist()] + df_export.values.tolist()
+
+    metadata_list = [
+        {'專案名稱': name,
+         '專案交貨日': data['due_date'].strftime(DATE_FORMAT) if isinstance(data['due_date'], (datetime, date)) else str(data['due_date']),
+         '緩衝天數': int(data['buffer_days']),
+         '最後修改': str(data['last_modified'])}
+        for name, data in metadata_to_write.items()
+    ]
+    metadata_df = pd.DataFrame(metadata_list)
+    metadata_values = [] if metadata_df.empty else \
+        [metadata_df.columns.values.tolist()] + metadata_df.values.tolist()
+    return data_values, metadata_values
+
+@st.cache_resource
+def get_sheet_write_state():
+    """整個 server process 共用的寫入狀態：上次寫入快照、序列化鎖、背景寫入的最後錯誤。"""
+    return {'lock': threading.Lock(), 'snapshots': None, 'last_error': None}
+
+# 背景寫入的合併窗口與 429/5xx 重試上限
+WRITE_DEBOUNCE_SECONDS = 0.75
+WRITE_RETRY_ATTEMPTS = 4
+
+def _push_values_to_sheets(data_values, metadata_values):
+    """實際送出 Sheets 請求；前景與背景執行緒共用，以 process 級快照做差異寫入。
+    配額被打爆 (429) 或暫時性 5xx 時以指數退避重試。"""
+    state = get_sheet_write_state()
+    with state['lock']:
+        last_exc = None
+        for attempt in range(WRITE_RETRY_ATTEMPTS):
+            try:
+                sh = get_spreadsheet()
+
+                # 有上次寫入的快照時只推差異列；否則 (冷啟動) 整表重寫。
+                # 兩張工作表仍合併成單一 batch 請求，API 次數減半且寫入具原子性。
+                snapshots = state['snapshots']
+                if snapshots is not None:
+                    batch_data = (_diff_value_ranges(DATA_SHEET_NAME, snapshots['data'], data_values)
+                                  + _diff_value_ranges(METADATA_SHEET_NAME, snapshots['metadata'], metadata_values))
+                    if batch_data:
+                        sh.values_batch_update(body={'valueInputOption': 'RAW', 'data': batch_data})
+                else:
+                    batch_data = [{'range': f"'{DATA_SHEET_NAME}'!A1", 'values': data_values}]
+                    if metadata_values:
+                        batch_data.append({'range': f"'{METADATA_SHEET_NAME}'!A1", 'values': metadata_values})
+                    sh.values_batch_clear(body={'ranges': [f"'{DATA_SHEET_NAME}'", f"'{METADATA_SHEET_NAME}'"]})
+                    sh.values_batch_update(body={'valueInputOption': 'RAW', 'data': batch_data})
+
+                state['snapshots'] = {'data': data_values, 'metadata': metadata_values}
+                return
+            except gspread.exceptions.APIError as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if status not in (429, 500, 502, 503) or attempt == WRITE_RETRY_ATTEMPTS - 1:
+                    raise
+                last_exc = e
+                logger.warning(f"Sheets 寫入暫時失敗 (HTTP {status})，{0.5 * (2 ** attempt):.1f}s 後重試")
+                time.sleep(0.5 * (2 ** attempt))
+        raise last_exc
+
+def _payload_is_unchanged(data_values, metadata_values):
+    """與上次寫入的快照完全相同時回傳 True，讓無修改的儲存動作不進寫入管線。"""
+    snapshots = get_sheet_write_state()['snapshots']
+    return (snapshots is not None
+            and snapshots['data'] == data_values
+            and snapshots['metadata'] == metadata_values)
 
 def write_data_to_sheets(df_to_write, metadata_to_write):
     if st.session_state.get('data_load_failed', False) or not SHEET_URL: return False
-        
-    try:
-        gc = gspread.service_account(filename=GSHEETS_CREDENTIALS)
-        sh = gc.open_by_url(SHEET_URL)
-        
-        # 寫入 Data
-        df_export = df_to_write.drop(columns=['交期判定', '交期顯示', '預覽', '附件名稱'], errors='ignore')
-        for col in ['預計交貨日', '採購最慢到貨日']:
-            if col in df_export.columns:
-                df_export[col] = pd.to_datetime(df_export[col], errors='coerce').dt.strftime(DATE_FORMAT).fillna("")
-        
-        df_export = df_export.fillna("")
-        for col in ['選取', '標記刪除']:
-            if col in df_export.columns: df_export[col] = df_export[col].apply(bool)
-        if '附件' in df_export.columns: df_export['附件'] = df_export['附件'].astype(str)
-        
-        try: data_ws = sh.worksheet(DATA_SHEET_NAME)
-        except: return False
 
-        data_ws.clear()
-        data_ws.update([df_export.columns.values.tolist()] + df_export.astype(object).values.tolist())
-        
-        # 寫入 Metadata
-        metadata_list = [
-            {'專案名稱': name, 
-             '專案交貨日': data['due_date'].strftime(DATE_FORMAT) if isinstance(data['due_date'], (datetime, date)) else str(data['due_date']),
-             '緩衝天數': int(data['buffer_days']), 
-             '最後修改': str(data['last_modified'])}
-            for name, data in metadata_to_write.items()
-        ]
-        metadata_df = pd.DataFrame(metadata_list)
-        try: metadata_ws = sh.worksheet(METADATA_SHEET_NAME)
-        except: return False
-
-        metadata_ws.clear()
-        if not metadata_df.empty:
-            metadata_ws.update([metadata_df.columns.values.tolist()] + metadata_df.values.tolist())
-            
-        st.cache_data.clear()
+    try:
+        payload = _prepare_sheet_values(df_to_write, metadata_to_write)
+        if _payload_is_unchanged(*payload):
+            return True
+        _push_values_to_sheets(*payload)
+        # 針對性失效：只把資料版本 +1，讓讀取快取換 key；
+        # 不再 st.cache_data.clear() 連帶清掉 signed URL / 預算聚合等無關快取
+        st.session_state.data_version = st.session_state.get('data_version', 0) + 1
         return True
     except Exception as e:
         st.error(f"❌ 寫入失敗: {e}")
         return False
 
+@st.cache_resource
+def get_write_queue():
+    """啟動背景寫入執行緒 (每個 server process 一條)，回傳其佇列。"""
+    q = queue.Queue()
+    state = get_sheet_write_state()
+
+    def worker():
+        while True:
+            payload = q.get()
+            # 等一小段時間讓連續操作落進佇列，再只寫最新的快照
+            time.sleep(WRITE_DEBOUNCE_SECONDS)
+            while True:
+                try: payload = q.get_nowait()
+                except queue.Empty: break
+            try:
+                _push_values_to_sheets(*payload)
+                state['last_error'] = None
+            except Exception as e:
+                logger.error(f"背景寫入 Sheets 失敗: {e}")
+                state['last_error'] = str(e)
+
+    threading.Thread(target=worker, daemon=True).start()
+    return q
+
+def queue_write_to_sheets(df_to_write, metadata_to_write):
+    """非阻塞寫入：在 script 執行緒先做好值快照，丟進背景佇列後立即返回。"""
+    if st.session_state.get('data_load_failed', False) or not SHEET_URL: return False
+    payload = _prepare_sheet_values(df_to_write, metadata_to_write)
+    if _payload_is_unchanged(*payload):
+        return True
+    get_write_queue().put(payload)
+    st.session_state.data_version = st.session_state.get('data_version', 0) + 1
+    return True
+
 
 # ******************************
 # *--- 5. 邏輯處理 (Actions) ---*
 # ******************************
 
+@st.cache_data(show_spinner=False, hash_funcs=_DF_HASH_FUNCS)
+def compute_item_budgets(df):
+    """每個 (專案, 項目) 的預算：有勾選取勾選總和，否則取最低報價。一次 groupby 算完所有組。"""
+    if df.empty: return pd.Series(dtype=float)
+    min_quote = df.groupby(['專案名稱', '專案項目'])['總價'].min()
+    selected_sum = df[df['選取'] == True].groupby(['專案名稱', '專案項目'])['總價'].sum()
+    return selected_sum.reindex(min_quote.index).fillna(min_quote)
+
+@st.cache_data(show_spinner=False, hash_funcs=_DF_HASH_FUNCS)
 def calculate_dashboard_metrics(df_state, project_metadata_state):
     total_projects = len(project_metadata_state)
-    total_budget = 0
-    df = df_state.copy()
-    if df.empty: return 0, 0, 0, 0
-    
-    for _, proj_data in df.groupby('專案名稱'):
-        if proj_data['專案名稱'].iloc[0] not in project_metadata_state: continue
-        for _, item_df in proj_data.groupby('專案項目'):
-            selected = item_df[item_df['選取'] == True]
-            total_budget += selected['總價'].sum() if not selected.empty else item_df['總價'].min()
-    
-    temp = df.copy()
-    temp['d'] = pd.to_datetime(temp['預計交貨日'], errors='coerce')
-    temp['l'] = pd.to_datetime(temp['採購最慢到貨日'], errors='coerce')
-    risk_items = (temp['d'] > temp['l']).sum()
-    
-    pending = df[~df['狀態'].isin(['已收貨', '取消'])].shape[0]
+    if df_state.empty: return 0, 0, 0, 0
+
+    budgets = compute_item_budgets(df_state)
+    in_meta = budgets.index.get_level_values('專案名稱').isin(project_metadata_state)
+    total_budget = budgets[in_meta].sum()
+
+    d = pd.to_datetime(df_state['預計交貨日'], errors='coerce')
+    l = pd.to_datetime(df_state['採購最慢到貨日'], errors='coerce')
+    risk_items = (d > l).sum()
+
+    pending = (~df_state['狀態'].isin(['已收貨', '取消'])).sum()
     return total_projects, total_budget, risk_items, pending
 
 def calculate_project_budget(df, project_name):
-    proj_df = df[df['專案名稱'] == project_name]
-    total = 0
-    for _, item_df in proj_df.groupby('專案項目'):
-        sel = item_df[item_df['選取'] == True]
-        total += sel['總價'].sum() if not sel.empty else item_df['總價'].min()
-    return total
+    budgets = compute_item_budgets(df)
+    if budgets.empty: return 0
+    try: return budgets.xs(project_name, level='專案名稱').sum()
+    except KeyError: return 0
 
+@st.cache_data(show_spinner=False, hash_funcs=_DF_HASH_FUNCS)
 def calculate_latest_arrival_dates(df, metadata):
     if df.empty or not metadata: return df
-    meta_df = pd.DataFrame.from_dict(metadata, orient='index').reset_index().rename(columns={'index': '專案名稱'})
-    meta_df['due_date'] = meta_df['due_date'].apply(lambda x: pd.to_datetime(x).date())
-    meta_df['buffer_days'] = meta_df['buffer_days'].astype(int)
-    
-    df = pd.merge(df, meta_df[['專案名稱', 'due_date', 'buffer_days']], on='專案名稱', how='left')
-    df['due_date_ts'] = pd.to_datetime(df['due_date'])
-    df['採購最慢到貨日'] = (df['due_date_ts'] - df['buffer_days'].apply(lambda x: timedelta(days=x))).dt.strftime('%Y-%m-%d')
-    return df.drop(columns=['due_date', 'buffer_days', 'due_date_ts'], errors='ignore')
+    # 直接用專案名稱 map 查表，免去 merge 與逐列 apply
+    due = pd.Series({k: pd.Timestamp(v['due_date']) for k, v in metadata.items()})
+    buf = pd.Series({k: int(v['buffer_days']) for k, v in metadata.items()})
+    df = df.copy()
+    # 保持 datetime64 dtype，下游的 to_datetime 都變成零成本 pass-through，
+    # 不再每次 rerun 重新解析字串
+    df['採購最慢到貨日'] = df['專案名稱'].map(due) - pd.to_timedelta(df['專案名稱'].map(buf), unit='D')
+    return df
+
+MASTER_SAVE_COLS = ['選取', '供應商', '單價', '數量', '狀態', '標記刪除', '預計交貨日', '總價']
 
 def handle_master_save():
-    if not st.session_state.edited_dataframes:
+    frames = [e for e in st.session_state.edited_dataframes.values() if e is not None and not e.empty]
+    if not frames:
         st.info("無修改。")
         return
-    main_df = st.session_state.data.copy()
-    changed = False
-    
-    for _, edited_df in st.session_state.edited_dataframes.items():
-        if edited_df.empty: continue
-        for _, new_row in edited_df.iterrows():
-            idx_in_main = main_df[main_df['ID'] == new_row['ID']].index
-            if idx_in_main.empty: continue
-            main_idx = idx_in_main[0]
-            
-            row_changed = False
-            new_date = new_row['預計交貨日']
-            if pd.notna(new_date):
-                 new_date = pd.to_datetime(new_date).normalize()
-                 if main_df.loc[main_idx, '預計交貨日'] != new_date:
-                     main_df.loc[main_idx, '預計交貨日'] = new_date
-                     row_changed = True
-            
-            for col in ['選取', '供應商', '單價', '數量', '狀態', '標記刪除']:
-                if str(main_df.loc[main_idx, col]) != str(new_row[col]):
-                    main_df.loc[main_idx, col] = new_row[col]
-                    row_changed = True
-            
-            new_total = float(main_df.loc[main_idx, '單價']) * float(main_df.loc[main_idx, '數量'])
-            if main_df.loc[main_idx, '總價'] != new_total:
-                main_df.loc[main_idx, '總價'] = new_total
-                row_changed = True
-            
-            if row_changed:
-                main_df.loc[main_idx, '最後修改時間'] = datetime.now().strftime(DATETIME_FORMAT)
-                changed = True
+
+    # 所有編輯一次合併，整批向量化處理 (取代逐列 .loc 指派)
+    edits = pd.concat(frames, ignore_index=True).drop_duplicates(subset='ID', keep='last')
+    edits['預計交貨日'] = pd.to_datetime(edits['預計交貨日'], errors='coerce').dt.normalize()
+    edits['總價'] = edits['單價'].astype(float) * edits['數量'].astype(float)
+
+    # set_index 本身就回傳新 frame，前面不需再多複製一整份
+    main_indexed = st.session_state.data.set_index('ID')
+    edits_indexed = edits.set_index('ID')
+    edits_indexed = edits_indexed.loc[edits_indexed.index.intersection(main_indexed.index)]
+
+    old = main_indexed.loc[edits_indexed.index, MASTER_SAVE_COLS]
+    new = edits_indexed[MASTER_SAVE_COLS].copy()
+    # 日期欄位留空視為不修改，沿用原值
+    new['預計交貨日'] = new['預計交貨日'].fillna(pd.to_datetime(old['預計交貨日'], errors='coerce'))
+
+    changed_mask = pd.Series(False, index=edits_indexed.index)
+    for col in MASTER_SAVE_COLS:
+        o, n = old[col], new[col]
+        if col in ('單價', '數量', '總價'):
+            diff = ~np.isclose(o.astype(float), n.astype(float), equal_nan=True)
+        else:
+            diff = ~(o.eq(n) | (o.isna() & n.isna()))
+        changed_mask |= diff
+
+    changed_ids = changed_mask[changed_mask].index
+    changed = len(changed_ids) > 0
 
     if changed:
+        main_indexed.loc[changed_ids, MASTER_SAVE_COLS] = new.loc[changed_ids, MASTER_SAVE_COLS]
+        main_indexed.loc[changed_ids, '最後修改時間'] = now_str()
+        main_df = main_indexed.reset_index()
         st.session_state.data = main_df
         if write_data_to_sheets(main_df, st.session_state.project_metadata):
             st.session_state.edited_dataframes = {}
@@ -438,13 +669,18 @@ def handle_master_save():
     else:
         st.info("無修改。")
 
-def trigger_delete_confirmation():
+def _collect_marked_delete_ids():
+    """從編輯暫存中收集勾選刪除的 ID，只算一次並存入 session 供確認/執行共用。"""
     ids = []
     for edited_df in st.session_state.edited_dataframes.values():
-        if edited_df is not None:
-            for _, row in edited_df.iterrows():
-                if row['標記刪除']: ids.append(row['ID'])
-    
+        if edited_df is None or edited_df.empty: continue
+        marked = edited_df['標記刪除'].to_numpy(dtype=bool)
+        if marked.any(): ids.extend(edited_df['ID'].to_numpy()[marked].tolist())
+    return list(dict.fromkeys(ids))
+
+def trigger_delete_confirmation():
+    ids = _collect_marked_delete_ids()
+
     if not ids:
         st.warning("請先勾選 '刪除?'。")
         return
@@ -455,7 +691,8 @@ def trigger_delete_confirmation():
     st.rerun()
 
 def handle_batch_delete_quotes():
-    ids = st.session_state.get('pending_delete_ids', [])
+    # 直接重用 trigger 時算好的 ID 清單，不再重掃編輯暫存
+    ids = st.session_state.pop('pending_delete_ids', [])
     if not ids:
         st.session_state.show_delete_confirm = False
         st.rerun()
@@ -463,13 +700,12 @@ def handle_batch_delete_quotes():
 
     main_df = st.session_state.data
     quotes_to_del = main_df[main_df['ID'].isin(ids)]
-    
-    success = True
-    for _, row in quotes_to_del.iterrows():
-        if str(row.get('附件', '')).strip():
-            if not delete_file_from_gcs(str(row.get('附件', '')).strip()): success = False
-    
-    st.session_state.data = main_df[~main_df['ID'].isin(ids)].reset_index(drop=True)
+
+    # 附件一次收齊後用單一 batch 請求刪，不逐檔來回
+    success = delete_files_from_gcs(quotes_to_del['附件'].dropna().astype(str).tolist())
+
+    st.session_state.data = main_df.loc[~main_df['ID'].isin(ids)]
+    st.session_state.data.index = pd.RangeIndex(len(st.session_state.data))
     
     if write_data_to_sheets(st.session_state.data, st.session_state.project_metadata):
         st.session_state.show_delete_confirm = False
@@ -478,6 +714,9 @@ def handle_batch_delete_quotes():
         if not success: msg += " (部分附件刪除失敗)"
         st.success(msg)
         st.rerun()
+    else:
+        # 寫入失敗時把 ID 放回去，確認畫面仍可重試
+        st.session_state.pending_delete_ids = ids
 
 def handle_add_new_project():
     name = st.session_state.new_proj_name
@@ -487,9 +726,9 @@ def handle_add_new_project():
     st.session_state.project_metadata[name] = {
         'due_date': st.session_state.new_proj_due_date,
         'buffer_days': st.session_state.new_proj_buffer_days,
-        'last_modified': datetime.now().strftime(DATETIME_FORMAT)
+        'last_modified': now_str()
     }
-    write_data_to_sheets(st.session_state.data, st.session_state.project_metadata)
+    queue_write_to_sheets(st.session_state.data, st.session_state.project_metadata)
     st.success(f"✅ 專案 {name} 設定已儲存")
     st.rerun()
 
@@ -514,14 +753,16 @@ def handle_add_new_quote(latest_arrival):
         '專案項目': item, '供應商': st.session_state.quote_supplier, 
         '單價': st.session_state.quote_price, '數量': st.session_state.quote_qty, 
         '總價': st.session_state.quote_price * st.session_state.quote_qty, 
-        '預計交貨日': pd.to_datetime(delivery).normalize(), 
-        '狀態': st.session_state.quote_status, 
-        '採購最慢到貨日': pd.to_datetime(latest_arrival).normalize(), 
-        '標記刪除': False, '最後修改時間': datetime.now().strftime(DATETIME_FORMAT), '附件': ""
+        '預計交貨日': pd.Timestamp(delivery).normalize(),
+        '狀態': st.session_state.quote_status,
+        '採購最慢到貨日': pd.Timestamp(latest_arrival).normalize(),
+        '標記刪除': False, '最後修改時間': now_str(), '附件': ""
     }
     st.session_state.next_id += 1
-    st.session_state.data = pd.concat([st.session_state.data, pd.DataFrame([new_row])], ignore_index=True)
-    write_data_to_sheets(st.session_state.data, st.session_state.project_metadata)
+    # 以 index 指派原地補一列，不用 concat 重配整個 frame
+    main = st.session_state.data
+    main.loc[(main.index.max() + 1) if len(main) else 0] = pd.Series(new_row)
+    queue_write_to_sheets(st.session_state.data, st.session_state.project_metadata)
     st.success("✅ 報價新增成功")
     st.rerun()
 
@@ -533,28 +774,51 @@ def handle_project_modification():
     meta = st.session_state.project_metadata.pop(old)
     st.session_state.project_metadata[new] = meta
     st.session_state.data.loc[st.session_state.data['專案名稱'] == old, '專案名稱'] = new
-    write_data_to_sheets(st.session_state.data, st.session_state.project_metadata)
+    queue_write_to_sheets(st.session_state.data, st.session_state.project_metadata)
     st.rerun()
 
 def handle_delete_project(proj):
-    # 刪附件
-    for _, row in st.session_state.data[st.session_state.data['專案名稱'] == proj].iterrows():
-        delete_file_from_gcs(str(row.get('附件', '')).strip())
-    
+    # 附件整批刪除 (單一 batch 請求)
+    proj_rows = st.session_state.data['專案名稱'] == proj
+    delete_files_from_gcs(st.session_state.data.loc[proj_rows, '附件'].dropna().astype(str).tolist())
+
     if proj in st.session_state.project_metadata: del st.session_state.project_metadata[proj]
-    st.session_state.data = st.session_state.data[st.session_state.data['專案名稱'] != proj].reset_index(drop=True)
-    write_data_to_sheets(st.session_state.data, st.session_state.project_metadata)
+    # 直接用布林遮罩過濾後重設 index，避免 reset_index 觸發整個 DataFrame 的複製
+    st.session_state.data = st.session_state.data.loc[~proj_rows]
+    st.session_state.data.index = pd.RangeIndex(len(st.session_state.data))
+    queue_write_to_sheets(st.session_state.data, st.session_state.project_metadata)
     st.rerun()
 
+def handle_manual_refresh():
+    """手動從 Sheets 重新同步。平常 session 內完全不回 Sheets 讀，
+    只有按下按鈕才把 data_version +1 換掉讀取快取的 key 並覆蓋 session 資料。"""
+    st.session_state.data_version = st.session_state.get('data_version', 0) + 1
+    df, meta = load_data_from_sheets()
+    st.session_state.data = df
+    st.session_state.project_metadata = meta
+    st.session_state.next_id = df['ID'].max() + 1 if not df.empty else 1
+    st.session_state.edited_dataframes = {}
+
 
 # ******************************
 # *--- 6. UI 渲染 (Components) ---*
 # ******************************
 
+def get_cached_lookup_lists(df, project_metadata):
+    """側欄下拉選單用的排序清單，依 data_version 快取在 session，避免每次 rerun 重掃整欄。"""
+    version = st.session_state.get('data_version', 0)
+    cached = st.session_state.get('_lookup_lists')
+    if cached is None or cached[0] != version:
+        projs = sorted(project_metadata)
+        items = sorted(df['專案項目'].dropna().unique()) if not df.empty else []
+        cached = (version, projs, items)
+        st.session_state._lookup_lists = cached
+    return cached[1], cached[2]
+
 def render_sidebar_ui(df, project_metadata, today):
+    projs, items = get_cached_lookup_lists(df, project_metadata)
     with st.sidebar:
         with st.expander("✏️ 修改/刪除專案", expanded=False):
-            projs = sorted(list(project_metadata.keys()))
             if projs:
                 t = st.selectbox("目標專案", projs, key="edit_target_project")
                 op = st.selectbox("操作", ("修改專案資訊", "刪除專案"), key="project_operation_select")
@@ -574,7 +838,6 @@ def render_sidebar_ui(df, project_metadata, today):
             if st.button("儲存設定"): handle_add_new_project()
 
         with st.expander("➕ 新增報價", expanded=False):
-            projs = sorted(list(project_metadata.keys()))
             if not projs: st.warning("請先新增專案")
             else:
                 p = st.selectbox("專案", projs, key="quote_project_select")
@@ -582,7 +845,6 @@ def render_sidebar_ui(df, project_metadata, today):
                 latest = meta['due_date'] - timedelta(int(meta['buffer_days']))
                 st.caption(f"最慢: {latest}")
                 
-                items = sorted(df['專案項目'].unique().tolist())
                 sel_i = st.selectbox("項目", ['🆕 新增...'] + items, key="quote_item_select")
                 
                 if sel_i == '🆕 新增...': 
@@ -604,6 +866,18 @@ def render_sidebar_ui(df, project_metadata, today):
                 st.selectbox("狀態", STATUS_OPTIONS, key="quote_status")
                 if st.button("新增資料", type="primary"): handle_add_new_quote(latest)
 
+        if not df.empty:
+            st.download_button(
+                "📥 下載 Excel 報表",
+                data=convert_df_to_excel(df),
+                file_name=f"採購總表_{today.strftime('%Y%m%d')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+
+        sync_error = get_sheet_write_state()['last_error']
+        if sync_error: st.warning(f"⚠️ 背景同步失敗：{sync_error}")
+
+        st.button("🔄 重新整理", on_click=handle_manual_refresh)
         st.button("🚪 登出", on_click=logout, type="secondary")
 
 def render_dashboard(df, project_metadata):
@@ -642,7 +916,24 @@ def render_project_tables(df, project_metadata):
         
     current_preview_id = st.session_state.preview_from_table_id
 
-    for proj_name, proj_data in df.groupby('專案名稱'):
+    # 顯示用欄位一次算完整個 frame，迴圈內只切片；
+    # (thread pool 在這裡沒有意義：片段太小且 widget 一定要在主執行緒渲染)
+    view_df = df.copy()
+    for col in ['預計交貨日', '採購最慢到貨日']:
+        if col in view_df.columns:
+            parsed = pd.to_datetime(view_df[col], errors='coerce', cache=True)
+            view_df[col] = parsed.dt.date.where(parsed.notna(), None)
+    if '最後修改時間' not in view_df.columns: view_df['最後修改時間'] = ''
+    view_df['附件名稱'] = view_df['附件'].apply(lambda x: os.path.basename(x) if x else '')
+    try:
+        # 主要欄位在載入時已是 arrow backend；衍生欄位跟上，讓前端序列化零轉換
+        view_df['附件名稱'] = view_df['附件名稱'].astype('string[pyarrow]')
+    except (ImportError, TypeError):
+        pass
+    # *** 單選核心邏輯：根據 State 設定 Checkbox ***
+    view_df['預覽'] = (view_df['ID'] == current_preview_id) if current_preview_id is not None else False
+
+    for proj_name, proj_data in view_df.groupby('專案名稱'):
         meta = project_metadata.get(proj_name, {})
         budget = calculate_project_budget(df, proj_name)
         
@@ -659,43 +950,34 @@ def render_project_tables(df, project_metadata):
             for item_name, item_data in proj_data.groupby('專案項目'):
                 st.markdown(f"<span class='item-header'>📦 {item_name}</span>", unsafe_allow_html=True)
                 
-                edf = item_data.copy()
-                if '預計交貨日' in edf.columns:
-                    edf['預計交貨日'] = pd.to_datetime(edf['預計交貨日'], errors='coerce').apply(lambda x: x.date() if pd.notnull(x) else None)
-                if '採購最慢到貨日' in edf.columns:
-                    edf['採購最慢到貨日'] = pd.to_datetime(edf['採購最慢到貨日'], errors='coerce').apply(lambda x: x.date() if pd.notnull(x) else None)
-                
-                if '最後修改時間' not in edf: edf['最後修改時間'] = ''
-                
-                # 附件顯示處理
-                edf['附件名稱'] = edf['附件'].apply(lambda x: os.path.basename(x) if x else '')
-                
-                # *** 單選核心邏輯：根據 State 設定 Checkbox ***
-                edf['預覽'] = edf['ID'].apply(lambda x: True if x == current_preview_id else False)
-
-                col_cfg = {
-                    "選取": st.column_config.CheckboxColumn(width="tiny"),
-                    "單價": st.column_config.NumberColumn(format="$%d"),
-                    "總價": st.column_config.NumberColumn(format="$%d", disabled=True),
-                    "預計交貨日": st.column_config.DateColumn(format="YYYY-MM-DD", step=1),
-                    "狀態": st.column_config.SelectboxColumn(options=STATUS_OPTIONS),
-                    "最後修改時間": st.column_config.TextColumn(disabled=True),
-                    "附件名稱": st.column_config.TextColumn(disabled=True, width="medium"),
-                    "預覽": st.column_config.CheckboxColumn(width="small", label="預覽(單選)"),
-                    "標記刪除": st.column_config.CheckboxColumn(width="tiny")
-                }
-                
+                edf = item_data
+
                 editor_key = f"editor_{proj_name}_{item_name}"
+                # 上限 420px：超過就捲動，不讓長清單把整棵 DOM 撐爆
+                editor_height = min(150 + max(len(edf), 1) * 35, 420)
+
+                # 刪除確認中整頁唯讀：改用輕量的 st.dataframe，省掉編輯狀態追蹤與回寫
+                if st.session_state.show_delete_confirm:
+                    st.dataframe(edf, height=editor_height, column_order=EDITOR_COLUMN_ORDER,
+                                 column_config=EDITOR_COLUMN_CONFIG, hide_index=True,
+                                 use_container_width=True)
+                    continue
+
                 edited_val = st.data_editor(
-                    edf, 
-                    column_order=['選取', '供應商', '單價', '數量', '總價', '預計交貨日', '交期判定', '狀態', '最後修改時間', '附件名稱', '預覽', '標記刪除'],
-                    column_config=col_cfg,
+                    edf,
+                    height=editor_height,
+                    column_order=EDITOR_COLUMN_ORDER,
+                    column_config=EDITOR_COLUMN_CONFIG,
                     key=editor_key,
                     hide_index=True,
-                    use_container_width=True,
-                    disabled=st.session_state.show_delete_confirm
+                    use_container_width=True
                 )
-                st.session_state.edited_dataframes[item_name] = edited_val
+                # 以 editor_key (專案+項目) 當暫存 key：item 名稱可能跨專案重複。
+                # 跟畫面上的來源一樣就不進暫存，儲存/刪除路徑只需處理真的改過的表
+                if edited_val.equals(edf):
+                    st.session_state.edited_dataframes.pop(editor_key, None)
+                else:
+                    st.session_state.edited_dataframes[editor_key] = edited_val
 
                 # *** 單選核心邏輯：偵測點擊並重整 ***
                 if '預覽' in edited_val.columns:
@@ -708,17 +990,34 @@ def render_project_tables(df, project_metadata):
                                 st.rerun()
 
 
-def render_attachment_module(df):
+def _render_preview_image(signed_url, filename):
+    st.image(signed_url, caption=filename, use_container_width=True)
+
+def _render_preview_pdf(signed_url, filename):
+    # loading="lazy" 讓瀏覽器等 iframe 接近視窗才抓 PDF，不搶首屏渲染
+    st.markdown(f'<iframe src="{signed_url}" width="100%" height="600" loading="lazy"></iframe>', unsafe_allow_html=True)
+
+def _render_preview_download(signed_url, filename):
+    st.markdown(f"📄 [下載檔案]({signed_url})")
+
+# 副檔名 → 預覽元件的查表分派，新格式加一行即可
+_PREVIEW_RENDERERS = {
+    '.png': _render_preview_image, '.jpg': _render_preview_image, '.jpeg': _render_preview_image,
+    '.pdf': _render_preview_pdf,
+}
+
+def render_attachment_module(selected_rows):
     """
     【UI 優化版】附件管理中心
     使用卡片式佈局，移除複雜下拉選單，以表格點選為主。
+    只接收呼叫端切好的單列資料，不再拿整個 DataFrame。
     """
     st.markdown("---")
     st.subheader("📎 報價附件管理中心")
 
     # 1. 獲取當前選取的報價 ID
     selected_id = st.session_state.get('preview_from_table_id', None)
-    
+
     # 2. 如果沒有選取，顯示提示畫面
     if selected_id is None:
         st.info("👆 請在上方表格中勾選 **「預覽」** 欄位以檢視或上傳附件。")
@@ -726,7 +1025,7 @@ def render_attachment_module(df):
 
     # 3. 獲取該筆資料
     try:
-        row = df[df['ID'] == selected_id].iloc[0]
+        row = selected_rows.iloc[0]
         proj_name = row['專案名稱']
         item_name = row['專案項目']
         supplier = row['供應商']
@@ -771,38 +1070,34 @@ def render_attachment_module(df):
                 if st.button("☁️ 確認上傳至 GCS", type="primary", use_container_width=True):
                     new_path = save_uploaded_file(uploaded_file, selected_id)
                     if new_path:
-                        # 更新 Session Data
-                        idx = st.session_state.data[st.session_state.data['ID'] == selected_id].index[0]
-                        st.session_state.data.loc[idx, '附件'] = new_path
-                        st.session_state.data.loc[idx, '最後修改時間'] = datetime.now().strftime(DATETIME_FORMAT)
+                        # 更新 Session Data：row.name 就是原始 index 標籤，
+                        # 用 .at 做 O(1) 純量寫入，不再整欄布林掃描 + .loc
+                        idx = row.name
+                        main_df = st.session_state.data
+                        main_df.at[idx, '附件'] = new_path
+                        main_df.at[idx, '最後修改時間'] = now_str()
                         
                         # 寫入 Sheets
-                        if write_data_to_sheets(st.session_state.data, st.session_state.project_metadata):
-                            st.toast("上傳成功！")
-                            time.sleep(1)
-                            st.rerun()
+                        # 背景佇列寫入，不讓使用者等整張表序列化上傳
+                        queue_write_to_sheets(main_df, st.session_state.project_metadata)
+                        st.session_state._pending_toast = "上傳成功！"
+                        st.rerun()
 
         with col_preview:
             st.markdown("#### 👁️ 內容預覽")
             
             if current_file_path:
-                try:
-                    # 使用 Signed URL 獲取安全連結
-                    client = get_gcs_signing_client()
-                    bucket = client.bucket(GCS_BUCKET_NAME)
-                    blob = bucket.blob(current_file_path)
-                    signed_url = blob.generate_signed_url(version="v4", expiration=timedelta(minutes=10), method="GET")
-                    
-                    ext = os.path.splitext(current_filename)[1].lower()
-                    if ext in ['.png', '.jpg', '.jpeg']:
-                        st.image(signed_url, caption=current_filename, use_container_width=True)
-                    elif ext == '.pdf':
-                        st.markdown(f'<iframe src="{signed_url}" width="100%" height="600"></iframe>', unsafe_allow_html=True)
-                    else:
-                        st.markdown(f"📄 [下載檔案]({signed_url})")
-                        
-                except Exception as e:
-                    st.error(f"預覽失敗: {e}")
+                # 惰性載入：開關打開才簽 URL / 嵌入內容，純編輯其他列的 rerun 不做白工
+                if st.toggle("顯示預覽", value=True, key=f"show_preview_{selected_id}"):
+                    try:
+                        # 使用快取的 Signed URL，rerun 時不重新簽名
+                        signed_url = generate_signed_url_cached(current_file_path)
+
+                        ext = os.path.splitext(current_filename)[1].lower()
+                        _PREVIEW_RENDERERS.get(ext, _render_preview_download)(signed_url, current_filename)
+
+                    except Exception as e:
+                        st.error(f"預覽失敗: {e}")
             else:
                 st.info("無檔案可預覽")
 
@@ -812,34 +1107,38 @@ def render_attachment_module(df):
 # ******************************
 
 def run_app():
+    # session_state 每次存取都走 __getattr__，整段綁成區域變數
+    ss = st.session_state
+
+    # 上一輪動作留下的 toast (rerun 前不用 sleep 等它顯示)
+    pending_toast = ss.pop('_pending_toast', None)
+    if pending_toast: st.toast(pending_toast)
+
     # 初始化
-    if 'data' not in st.session_state:
+    if 'data' not in ss:
         df, meta = load_data_from_sheets()
-        st.session_state.data = df
-        st.session_state.project_metadata = meta
-        st.session_state.next_id = df['ID'].max() + 1 if not df.empty else 1
-        st.session_state.edited_dataframes = {}
-        st.session_state.show_delete_confirm = False
-        st.session_state.preview_from_table_id = None
-
-    # 自動計算
-    st.session_state.data = calculate_latest_arrival_dates(st.session_state.data, st.session_state.project_metadata)
-    
-    # 判斷交期
-    def judge(row):
-        try:
-            d = pd.to_datetime(row['預計交貨日'])
-            l = pd.to_datetime(row['採購最慢到貨日'])
-            if pd.isna(d) or pd.isna(l): return ""
-            return "❌" if d.date() > l.date() else "✅"
-        except: return ""
-    
-    if not st.session_state.data.empty:
-        st.session_state.data['交期判定'] = st.session_state.data.apply(judge, axis=1)
+        ss.data = df
+        ss.project_metadata = meta
+        ss.next_id = df['ID'].max() + 1 if not df.empty else 1
+        ss.edited_dataframes = {}
+        ss.show_delete_confirm = False
+        ss.preview_from_table_id = None
+
+    # 自動計算：只在資料版本變動 (寫入/重新整理) 後重算，單純的 widget 互動 rerun 直接跳過
+    version = ss.get('data_version', 0)
+    if ss.get('_enriched_version') != version:
+        ss.data = calculate_latest_arrival_dates(ss.data, ss.project_metadata)
+
+        # 判斷交期 (向量化比較，不逐列呼叫 Python 函式)
+        if not ss.data.empty:
+            d = pd.to_datetime(ss.data['預計交貨日'], errors='coerce').dt.normalize()
+            l = pd.to_datetime(ss.data['採購最慢到貨日'], errors='coerce').dt.normalize()
+            ss.data['交期判定'] = np.where(d.isna() | l.isna(), "", np.where(d > l, "❌", "✅"))
+        ss._enriched_version = version
 
     # 渲染畫面
-    df = st.session_state.data
-    meta = st.session_state.project_metadata
+    df = ss.data
+    meta = ss.project_metadata
     today = datetime.now().date()
     
     st.title(f"🛠️ 專案採購管理工具 {APP_VERSION}") 
@@ -847,9 +1146,19 @@ def run_app():
     
     render_sidebar_ui(df, meta, today)
     render_dashboard(df, meta)
+
+    # 沒有資料時後面的表格/批次/附件區塊全是空轉，直接提示返回，
+    # 不為空畫面配置一堆 widget state
+    if df.empty:
+        st.info("尚無資料，請先從側欄新增專案與報價。")
+        return
+
     render_batch_operations()
     render_project_tables(df, meta)
-    render_attachment_module(df) # 新版 UI
+    # 附件模組只需要被選取的那一列，先切好再傳 (row.name 保留原 index 供 .at 寫回)
+    sel_id = ss.preview_from_table_id
+    sel_rows = df.loc[df['ID'] == sel_id] if sel_id is not None else df.iloc[0:0]
+    render_attachment_module(sel_rows) # 新版 UI
 
 def main():
     login_form()